@@ -1,31 +1,244 @@
 import os
-import requests
+import asyncio
+import functools
+import hashlib
+import logging
+import math
+import queue
+import random
+import sqlite3
+import sys
 import time
-import json
+import urllib.parse
+import httpx
+import ijson
+import orjson
+import tiktoken
+from array import array
+from contextlib import closing
+from dataclasses import dataclass
+from xml.etree import ElementTree
 from dotenv import load_dotenv
+from logging.handlers import QueueHandler, QueueListener
 
 # Load environment variables
 load_dotenv()
 
-def transcribe_container():
-    """Transcribe all audio files in Azure Storage container"""
-    
-    # Get configuration
-    speech_key = os.getenv('AZURE_SPEECH_KEY')
-    speech_endpoint = os.getenv('AZURE_SPEECH_ENDPOINT')
-    container_uri = os.getenv('CONTAINER_URI')
-    
-    if not all([speech_key, speech_endpoint, container_uri]):
-        raise ValueError("Missing required environment variables: AZURE_SPEECH_KEY, AZURE_SPEECH_ENDPOINT, CONTAINER_URI")
-    
-    print(f"Transcribing container: {container_uri}")
+logger = logging.getLogger(__name__)
+
+# Azure Speech batch transcription REST API
+SPEECH_API = "speechtotext/v3.2"
+# Formats that can be given their own transcription job; any other blob sends the container through as one job
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.mp4', '.ogg', '.opus', '.flac', '.wma', '.aac', '.amr', '.webm', '.m4a', '.spx')
+# Transcription job submissions and status requests in flight at once
+JOB_CONCURRENCY = 8
+
+# Throttled and transient server errors that are worth retrying
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+MAX_RETRIES = 3
+
+# Concurrent result file downloads, kept below the point where blob storage starts throttling
+DOWNLOAD_CONCURRENCY = 16
+
+# Long transcripts are summarized in overlapping token windows, then the partial summaries are combined
+CHUNK_TOKENS = 3500
+CHUNK_OVERLAP = 200
+
+# Fixed instruction sent as the system message so every request shares an identical prefix
+SUMMARY_PROMPT = "Please provide a concise summary of the following text in 200 words."
+BATCH_PROMPT = (
+    "Summarize each value of the following JSON object separately, each in at most 200 words. "
+    'Reply with a JSON object of the form {"summaries": {"<key>": "<summary>"}} using the same keys.'
+)
+# 200 words is roughly 260 tokens; output length dominates completion latency
+SUMMARY_MAX_TOKENS = 280
+# The batched reduce is not streamed and generates every file's summary before replying, so it needs longer
+# than the default 30s read timeout
+BATCH_TIMEOUT = httpx.Timeout(30.0, read=300.0)
+
+def async_client(**kwargs):
+    """Async HTTP/2 client, so concurrent requests to one host multiplex over a single TLS connection"""
+    # The transport retries failed connection attempts; send() retries throttled and 5xx responses.
+    # httpx already sends Accept-Encoding: gzip, deflate and adds br once brotli is installed, which
+    # matters most for result files, where JSON with per-phrase N-best compresses several times over
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            retries=3
+        ),
+        timeout=30.0,
+        **kwargs
+    )
+
+def speech_client(config):
+    """Client for the Speech transcription API, with the subscription key set once for every call"""
+    return async_client(
+        base_url=f"{config.speech_endpoint}{SPEECH_API}/",
+        headers={'Ocp-Apim-Subscription-Key': config.speech_key}
+    )
+
+def openai_client(config):
+    """Client for the Azure OpenAI deployment, with the API key set once for every call"""
+    return async_client(
+        base_url=f"{config.openai_endpoint}openai/deployments/{config.deployment}/",
+        headers={'api-key': config.openai_key}
+    )
+
+# Summaries of near-duplicate inputs are reused when their embeddings are at least this similar
+SEMANTIC_CACHE_THRESHOLD = 0.95
+# Input limit of the text-embedding-ada-002 and text-embedding-3 models
+EMBEDDING_MAX_TOKENS = 8191
+
+def cache_key(*parts):
+    """Hash the parts that identify a cached result"""
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+def _cache_connection(config):
+    conn = sqlite3.connect(config.cache_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS semantic_cache "
+        "(namespace TEXT NOT NULL, embedding BLOB NOT NULL, summary TEXT NOT NULL, created REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS semantic_cache_namespace ON semantic_cache (namespace, created)")
+    return conn
+
+def cache_get(config, key):
+    """Return the cached value for key, or None on a miss or once it is older than the cache TTL"""
+    with closing(_cache_connection(config)) as conn:
+        row = conn.execute(
+            "SELECT value FROM cache_entries WHERE key = ? AND created > ?",
+            (key, time.time() - config.cache_ttl)
+        ).fetchone()
+    return orjson.loads(row[0]) if row else None
+
+def cache_set(config, key, value):
+    """Store a JSON-serializable value under key, dropping entries older than the cache TTL"""
+    with closing(_cache_connection(config)) as conn, conn:
+        # Transcript entries hold every phrase of a container, so expired ones are not kept around
+        conn.execute("DELETE FROM cache_entries WHERE created <= ?", (time.time() - config.cache_ttl,))
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (key, value, created) VALUES (?, ?, ?)",
+            (key, orjson.dumps(value).decode(), time.time())
+        )
+
+def _unit_vector(values):
+    norm = math.sqrt(sum(x * x for x in values)) or 1.0
+    return array('f', (x / norm for x in values))
+
+def semantic_cache_get(config, namespace, embedding):
+    """Return the unexpired summary whose input is most similar to embedding, or None below the threshold"""
+    query = _unit_vector(embedding)
+    best, best_score = None, SEMANTIC_CACHE_THRESHOLD
+    with closing(_cache_connection(config)) as conn:
+        rows = conn.execute(
+            "SELECT embedding, summary FROM semantic_cache WHERE namespace = ? AND created > ?",
+            (namespace, time.time() - config.cache_ttl)
+        )
+        for blob, summary in rows:
+            vector = array('f')
+            vector.frombytes(blob)
+            # Both vectors are unit length, so the dot product is the cosine similarity
+            score = sum(x * y for x, y in zip(query, vector))
+            if score >= best_score:
+                best, best_score = summary, score
+    return best
+
+def semantic_cache_set(config, namespace, embedding, summary):
+    """Store a summary under the embedding of its input, dropping entries older than the cache TTL"""
+    with closing(_cache_connection(config)) as conn, conn:
+        # Lookups scan every live row, so expired ones are not left to accumulate
+        conn.execute("DELETE FROM semantic_cache WHERE created <= ?", (time.time() - config.cache_ttl,))
+        conn.execute(
+            "INSERT INTO semantic_cache (namespace, embedding, summary, created) VALUES (?, ?, ?, ?)",
+            (namespace, _unit_vector(embedding).tobytes(), summary, time.time())
+        )
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Azure settings, read and validated once at startup"""
+    speech_key: str
+    speech_endpoint: str
+    container_uri: str
+    openai_key: str
+    openai_endpoint: str
+    deployment: str
+    # Upper bound on in-flight Azure OpenAI requests, to stay inside the deployment's rate limit
+    openai_concurrency: int
+    # Status checks allowed before a transcription job is abandoned
+    max_poll_attempts: int
+    # Embedding deployment for the semantic summary cache; the cache is off when unset
+    embedding_deployment: str | None
+    # Deployment names are arbitrary, so the model whose tokenizer to count with is set separately
+    tokenizer_model: str
+    # Input budget for a single request: the model's context minus room for the prompt and the summary.
+    # The 7500 default fits the 8k gpt-4 and should be raised along with tokenizer_model for larger models
+    max_input_tokens: int
+    # Reduce several files in one JSON-mode request; the deployment's model must support response_format
+    batch_reduce: bool
+    # On-disk cache of transcripts and summaries so reruns skip Speech and OpenAI, and its entries' lifetime
+    cache_path: str
+    cache_ttl: int
+
+def load_config():
+    """Read configuration from the environment, failing fast on missing settings"""
+    required = ['AZURE_SPEECH_KEY', 'AZURE_SPEECH_ENDPOINT', 'CONTAINER_URI', 'AZURE_OPENAI_KEY', 'AZURE_OPENAI_ENDPOINT']
+    missing = [name for name in required if not os.getenv(name)]
+    if missing:
+        raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
     
-    # Create transcription request
+    return Config(
+        speech_key=os.getenv('AZURE_SPEECH_KEY'),
+        speech_endpoint=os.getenv('AZURE_SPEECH_ENDPOINT'),
+        container_uri=os.getenv('CONTAINER_URI'),
+        openai_key=os.getenv('AZURE_OPENAI_KEY'),
+        openai_endpoint=os.getenv('AZURE_OPENAI_ENDPOINT'),
+        deployment=os.getenv('DEPLOYMENT_NAME', 'gpt-4'),
+        openai_concurrency=int(os.getenv('OPENAI_CONCURRENCY', '8')),
+        max_poll_attempts=int(os.getenv('MAX_POLL_ATTEMPTS', '240')),
+        embedding_deployment=os.getenv('EMBEDDING_DEPLOYMENT_NAME'),
+        tokenizer_model=os.getenv('TOKENIZER_MODEL', 'gpt-4'),
+        max_input_tokens=int(os.getenv('MAX_INPUT_TOKENS', '7500')),
+        batch_reduce=os.getenv('BATCH_REDUCE', '').lower() in ('1', 'true', 'yes'),
+        cache_path=os.getenv('CACHE_PATH', '.cache.sqlite3'),
+        cache_ttl=int(os.getenv('CACHE_TTL', '86400'))
+    )
+
+async def list_blobs(blobs, container_uri):
+    """List the container's blobs as (name, etag) pairs through the Blob REST API, following continuation markers"""
+    listing = []
+    marker = None
+    while True:
+        params = {'restype': 'container', 'comp': 'list'}
+        if marker:
+            params['marker'] = marker
+        # Passing params= would replace the SAS token in the query string rather than extend it
+        response = await send(blobs, 'GET', httpx.URL(container_uri).copy_merge_params(params))
+        if response.status_code != 200:
+            raise Exception(f"Failed to list container: {response.status_code} - {response.text}")
+        root = ElementTree.fromstring(response.content)
+        listing.extend(
+            (blob.findtext('Name'), blob.findtext('Properties/Etag')) for blob in root.iter('Blob')
+        )
+        marker = root.findtext('NextMarker')
+        if not marker:
+            return listing
+
+def blob_url(container_uri, name):
+    """URL of one blob in the container, authorized with the container's SAS token"""
+    base, _, sas = container_uri.partition('?')
+    url = f"{base.rstrip('/')}/{urllib.parse.quote(name)}"
+    return f"{url}?{sas}" if sas else url
+
+async def create_transcription(config, speech, display_name, content, semaphore):
+    """Submit a transcription job for content and poll it to completion, returning the result file listing URL"""
     transcription_data = {
-        "displayName": "Container transcription",
-        "description": "Transcribe all audio files in container",
+        "displayName": display_name,
         "locale": "en-US",
-        "contentContainerUrl": container_uri,
+        **content,
         "properties": {
             "wordLevelTimestampsEnabled": False,
             "punctuationMode": "DictatedAndAutomatic",
@@ -34,14 +247,9 @@ def transcribe_container():
     }
     
     # Submit transcription job
-    url = f"{speech_endpoint}speechtotext/v3.1/transcriptions"
-    headers = {
-        'Ocp-Apim-Subscription-Key': speech_key,
-        'Content-Type': 'application/json'
-    }
-    
-    print("Creating transcription job...")
-    response = requests.post(url, headers=headers, json=transcription_data)
+    logger.info(f"Creating transcription job for {display_name}...")
+    async with semaphore:
+        response = await send(speech, 'POST', "transcriptions", json=transcription_data)
     
     if response.status_code != 201:
         raise Exception(f"Failed to create transcription: {response.status_code} - {response.text}")
@@ -49,129 +257,575 @@ def transcribe_container():
     # Get transcription ID
     location = response.headers.get('location')
     transcription_id = location.split('/')[-1]
-    print(f"Transcription job created with ID: {transcription_id}")
+    logger.info(f"Transcription job created with ID: {transcription_id}")
     
     # Poll for completion
-    return poll_transcription(speech_endpoint, speech_key, transcription_id)
+    return await poll_transcription(config, speech, transcription_id, semaphore)
 
-def poll_transcription(endpoint, key, transcription_id):
-    """Poll transcription status until completion"""
-    url = f"{endpoint}speechtotext/v3.1/transcriptions/{transcription_id}"
-    headers = {'Ocp-Apim-Subscription-Key': key}
+async def transcribe_container(config, speech, listing, fetch):
+    """Transcribe the container's audio files, returning fetch(job, name, files_url) per job, or None where a job failed"""
+    logger.info(f"Transcribing container: {config.container_uri}")
+    # Bounds individual requests rather than whole jobs, so every job is submitted and polled promptly
+    semaphore = asyncio.Semaphore(JOB_CONCURRENCY)
     
-    print("Polling transcription status...")
+    async def transcribe(job, name, content):
+        files_url = await create_transcription(config, speech, name or "Container transcription", content, semaphore)
+        # Fetch this job's results straight away, while the other jobs are still being polled
+        return await fetch(job, name, files_url)
     
-    while True:
-        response = requests.get(url, headers=headers)
+    async def transcribe_file(job, name):
+        try:
+            return await transcribe(job, name, {"contentUrls": [blob_url(config.container_uri, name)]})
+        except Exception as e:
+            # Each file has its own job, so one failure need not lose the other files' transcripts
+            logger.error(f"Transcription of {name} failed: {e}")
+            return None
+    
+    audio = [name for name, _ in listing if name.lower().endswith(AUDIO_EXTENSIONS)]
+    unrecognized = [name for name, _ in listing if not name.lower().endswith(AUDIO_EXTENSIONS)]
+    for name in unrecognized:
+        logger.warning(f"Unrecognized audio format for {name}, transcribing the container as a single job")
+    if len(audio) <= 1 or unrecognized:
+        return [await transcribe(0, None, {"contentContainerUrl": config.container_uri})]
+    
+    # A single job finishes with its slowest file; separate jobs are processed in parallel by the
+    # service and each one's results are ready as soon as that file is done
+    return await asyncio.gather(*[transcribe_file(job, name) for job, name in enumerate(audio)])
+
+def _json(response):
+    """Decode a response body with orjson, which is much faster than stdlib json on large payloads"""
+    return orjson.loads(response.content)
+
+def _next_delay(attempt):
+    """Truncated exponential backoff with jitter for status polling, capped at 60s"""
+    return min(60, 2 * 2 ** min(attempt, 5)) * random.uniform(0.8, 1.2)
+
+def _retry_after(response, attempt):
+    """Seconds to wait before the next request, preferring the server's Retry-After hint"""
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return _next_delay(attempt)
+
+async def send(client, method, url, stream=False, **kwargs):
+    """Send a request, retrying throttled and transient 5xx responses; streamed responses must be closed by the caller"""
+    if 'json' in kwargs:
+        # Encode JSON bodies with orjson, once, rather than with stdlib json on every attempt
+        kwargs['content'] = orjson.dumps(kwargs.pop('json'))
+        kwargs['headers'] = {**kwargs.get('headers', {}), 'Content-Type': 'application/json'}
+    for attempt in range(MAX_RETRIES + 1):
+        response = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return response
+        await response.aclose()
+        delay = _retry_after(response, attempt)
+        logger.warning(f"Request throttled ({response.status_code}), retrying in {delay:.0f}s...")
+        await asyncio.sleep(delay)
+
+async def poll_transcription(config, speech, transcription_id, semaphore):
+    """Poll transcription status until completion, returning the result file listing URL"""
+    url = f"transcriptions/{transcription_id}"
+    
+    logger.info("Polling transcription status...")
+    
+    for attempt in range(config.max_poll_attempts):
+        async with semaphore:
+            response = await send(speech, 'GET', url)
         
         if response.status_code != 200:
             raise Exception(f"Failed to get transcription status: {response.status_code}")
         
-        result = response.json()
+        result = _json(response)
         status = result.get('status')
-        print(f"Transcription status: {status}")
+        logger.info(f"Transcription status: {status}")
         
         if status == "Succeeded":
-            return get_results(endpoint, key, transcription_id)
+            # The status response links straight to the result file listing
+            return result.get('links', {}).get('files', f"{url}/files")
         elif status == "Failed":
             error_msg = result.get('properties', {}).get('error', {}).get('message', 'Unknown error')
             raise Exception(f"Transcription failed: {error_msg}")
         elif status in ["Running", "NotStarted"]:
-            print("Transcription in progress, waiting...")
-            time.sleep(5)
+            logger.info("Transcription in progress, waiting...")
+            await asyncio.sleep(_retry_after(response, attempt))
         else:
-            print(f"Unknown status: {status}")
-            time.sleep(5)
-
-def get_results(endpoint, key, transcription_id):
-    """Get transcription results"""
-    url = f"{endpoint}speechtotext/v3.1/transcriptions/{transcription_id}/files"
-    headers = {'Ocp-Apim-Subscription-Key': key}
-    
-    response = requests.get(url, headers=headers)
+            logger.warning(f"Unknown status: {status}")
+            await asyncio.sleep(_retry_after(response, attempt))
     
+    raise TimeoutError(f"Transcription {transcription_id} did not finish after {config.max_poll_attempts} status checks")
+
+async def iter_json_items(response, prefix):
+    """Yield the items under prefix from a streamed JSON response as soon as each is parsed"""
+    items = ijson.sendable_list()
+    parser = ijson.items_coro(items, prefix)
+    async for chunk in response.aiter_bytes():
+        parser.send(chunk)
+        for item in items:
+            yield item
+        del items[:]
+    parser.close()
+    for item in items:
+        yield item
+
+async def fetch_transcript(client, url, filename, encoding, submit):
+    """Stream-parse a result file into its list of recognized phrases, returning None if it cannot be downloaded"""
+    response = await send(client, 'GET', url, stream=True)
+    try:
+        if response.status_code != 200:
+            logger.warning(f"Failed to download results for {filename}: {response.status_code}")
+            return None
+        # Parse phrase by phrase as the body arrives instead of loading the whole document, and hand
+        # each token window to submit as soon as it fills so summarizing overlaps the download
+        chunker = TranscriptChunker(filename, encoding)
+        phrases = []
+        async for phrase in iter_json_items(response, 'recognizedPhrases.item'):
+            nbest = phrase.get('nBest')
+            if nbest:
+                display = nbest[0]['display']
+                phrases.append(display)
+                for chunk in chunker.feed_phrase(display):
+                    submit(chunk)
+        for chunk in chunker.flush():
+            submit(chunk)
+        return phrases
+    finally:
+        await response.aclose()
+
+async def get_results(speech, blobs, files_url, summarizer, semaphore, job=0, name=None):
+    """Get a job's transcription results and whether every result file downloaded; name labels a single-file job"""
+    response = await send(speech, 'GET', files_url)
     if response.status_code != 200:
         raise Exception(f"Failed to get results: {response.status_code}")
+    files = _json(response).get('values', [])
+    
+    transcription_files = [
+        file_data for file_data in files
+        if file_data.get('kind') == 'Transcription' and file_data.get('links', {}).get('contentUrl')
+    ]
+    
+    async def bounded_fetch(index, file_data):
+        async with semaphore:
+            return await fetch_transcript(
+                blobs,
+                file_data['links']['contentUrl'],
+                name or file_data.get('name', 'unknown'),
+                summarizer.encoding,
+                functools.partial(summarizer.submit, (job, index))
+            )
+    
+    transcripts = await asyncio.gather(*[
+        bounded_fetch(index, file_data) for index, file_data in enumerate(transcription_files)
+    ])
     
-    files = response.json().get('values', [])
     all_transcriptions = {}
     
-    for file_data in files:
-        if file_data.get('kind') == 'Transcription':
-            filename = file_data.get('name', 'unknown')
-            results_url = file_data.get('links', {}).get('contentUrl')
-            
-            if results_url:
-                results_response = requests.get(results_url)
-                if results_response.status_code == 200:
-                    results = results_response.json()
-                    if 'recognizedPhrases' in results:
-                        text_parts = []
-                        for phrase in results['recognizedPhrases']:
-                            if 'nBest' in phrase and phrase['nBest']:
-                                text_parts.append(phrase['nBest'][0]['display'])
-                        all_transcriptions[filename] = ' '.join(text_parts)
-    
-    return all_transcriptions
-
-def summarize_text(text):
-    """Summarize text using Azure OpenAI via direct HTTP requests"""
-    openai_key = os.getenv('AZURE_OPENAI_KEY')
-    openai_endpoint = os.getenv('AZURE_OPENAI_ENDPOINT')
-    deployment = os.getenv('DEPLOYMENT_NAME', 'gpt-4')
-    
-    if not openai_key or not openai_endpoint:
-        raise ValueError("Missing Azure OpenAI configuration")
+    for file_data, phrases in zip(transcription_files, transcripts):
+        if phrases is not None:
+            all_transcriptions[name or file_data.get('name', 'unknown')] = phrases
     
+    return all_transcriptions, None not in transcripts
+
+async def read_completion_stream(response, on_delta=None):
+    """Assemble the message content from a streamed chat completion's server-sent events, passing each delta to on_delta"""
+    parts = []
+    async for line in response.aiter_lines():
+        if not line.startswith('data: '):
+            continue
+        payload = line[len('data: '):]
+        if payload == '[DONE]':
+            break
+        # Azure sends content-filter frames with no choices alongside the deltas
+        choices = orjson.loads(payload).get('choices')
+        if choices:
+            content = choices[0].get('delta', {}).get('content')
+            if content:
+                parts.append(content)
+                if on_delta:
+                    on_delta(content)
+    return ''.join(parts)
+
+async def embed(config, chat, text):
+    """Embed text with the configured Azure OpenAI embedding deployment, truncated to the model's input limit"""
+    url = (
+        f"{config.openai_endpoint}openai/deployments/{config.embedding_deployment}"
+        "/embeddings?api-version=2023-12-01-preview"
+    )
+    # Embedding models use cl100k_base, which get_encoding falls back to for a deployment name.
+    # The embedding only decides cache hits, so a prefix of an over-long input is good enough
+    encoding = get_encoding(config.embedding_deployment)
+    tokens = encoding.encode(text)
+    if len(tokens) > EMBEDDING_MAX_TOKENS:
+        text = encoding.decode(tokens[:EMBEDDING_MAX_TOKENS])
+    response = await send(chat, 'POST', url, json={"input": text})
+    if response.status_code != 200:
+        raise Exception(f"Embedding failed: {response.status_code} - {response.text}")
+    return _json(response)['data'][0]['embedding']
+
+def summary_cache_key(config, text):
+    """Exact cache key of the summary of text"""
+    return cache_key('summary', config.deployment, SUMMARY_PROMPT, text)
+
+async def summarize_text(config, chat, text, on_delta=None):
+    """Summarize text using Azure OpenAI via direct HTTP requests, streaming the summary to on_delta"""
     # Use direct HTTP requests (working method)
-    url = f"{openai_endpoint}openai/deployments/{deployment}/chat/completions?api-version=2023-12-01-preview"
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": openai_key
+    url = "chat/completions?api-version=2023-12-01-preview"
+    
+    key = summary_cache_key(config, text)
+    cached = cache_get(config, key)
+    if cached is not None:
+        logger.info("Using cached summary")
+        if on_delta:
+            on_delta(cached)
+        return cached
+    
+    # Near-duplicate inputs, such as a rerun over a slightly changed container, share summaries as long
+    # as they were produced by the same deployment and prompt
+    namespace = cache_key('semantic', config.container_uri.split('?')[0], config.deployment, SUMMARY_PROMPT)
+    embedding = None
+    if config.embedding_deployment:
+        try:
+            embedding = await embed(config, chat, text)
+            # Scoring every stored vector is pure Python, so keep it off the event loop
+            cached = await asyncio.to_thread(semantic_cache_get, config, namespace, embedding)
+        except Exception as e:
+            # The semantic cache is only an optimization; a failure here must not stop the summary
+            logger.warning(f"Semantic cache unavailable, summarizing without it: {e}")
+            embedding = None
+        if cached is not None:
+            logger.info("Using semantically cached summary")
+            if on_delta:
+                on_delta(cached)
+            return cached
+    
+    data = {
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": text}
+        ],
+        "max_tokens": SUMMARY_MAX_TOKENS,
+        "temperature": 0.3,
+        "stop": ["\n\n\n"],
+        "stream": True
     }
     
-    prompt = f"""Please provide a concise summary of the following text in 200 words:
-
-{text}
+    logger.info("Sending summarization request...")
+    response = await send(chat, 'POST', url, stream=True, json=data)
+    try:
+        if response.status_code != 200:
+            await response.aread()
+            raise Exception(f"Summarization failed: {response.status_code} - {response.text}")
+        summary = await read_completion_stream(response, on_delta)
+    finally:
+        await response.aclose()
+    
+    cache_set(config, key, summary)
+    if embedding is not None:
+        await asyncio.to_thread(semantic_cache_set, config, namespace, embedding, summary)
+    return summary
 
-Summary:"""
+async def summarize_batch(config, chat, texts):
+    """Summarize each value of texts in one JSON-mode request, returning None if they do not fit or the reply is unusable"""
+    url = "chat/completions?api-version=2023-12-01-preview"
+    # Once a deployment has rejected JSON mode, later runs go straight to per-file requests
+    rejected_key = cache_key('json-mode-rejected', config.deployment)
+    if cache_get(config, rejected_key):
+        return None
+    payload = orjson.dumps(texts).decode()
+    # Every summary comes back in the same completion, so its output budget grows with the batch
+    tokens = len(get_encoding(config.tokenizer_model).encode(payload))
+    if tokens + SUMMARY_MAX_TOKENS * len(texts) > config.max_input_tokens:
+        return None
     
     data = {
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 500,
-        "temperature": 0.3
+        "messages": [
+            {"role": "system", "content": BATCH_PROMPT},
+            {"role": "user", "content": payload}
+        ],
+        "max_tokens": SUMMARY_MAX_TOKENS * len(texts),
+        "temperature": 0.3,
+        "response_format": {"type": "json_object"}
     }
     
-    print("Sending summarization request...")
-    response = requests.post(url, headers=headers, json=data)
+    logger.info(f"Sending batch summarization request for {len(texts)} texts...")
+    try:
+        response = await send(chat, 'POST', url, json=data, timeout=BATCH_TIMEOUT)
+    except httpx.TimeoutException:
+        logger.warning("Batch summarization timed out, summarizing individually")
+        return None
+    # Models without JSON mode, such as the 8k gpt-4, reject response_format with a 400
+    if response.status_code == 400:
+        cache_set(config, rejected_key, True)
+    if 400 <= response.status_code < 500:
+        logger.warning(f"Batch summarization rejected ({response.status_code}), summarizing individually")
+        return None
+    if response.status_code != 200:
+        raise Exception(f"Batch summarization failed: {response.status_code} - {response.text}")
     
-    if response.status_code == 200:
-        result = response.json()
-        return result['choices'][0]['message']['content']
-    else:
-        raise Exception(f"Summarization failed: {response.status_code} - {response.text}")
+    choice = _json(response)['choices'][0]
+    try:
+        summaries = orjson.loads(choice['message']['content'])['summaries']
+        summaries = {name: summaries[name] for name in texts}
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        summaries = None
+    if choice.get('finish_reason') != 'stop' or summaries is None or not all(isinstance(v, str) for v in summaries.values()):
+        logger.warning("Batch summarization reply was incomplete, summarizing individually")
+        return None
+    
+    # Stored as the per-file summaries, so a rerun finds them without batching again
+    for name, summary in summaries.items():
+        cache_set(config, summary_cache_key(config, texts[name]), summary)
+    return summaries
 
-def main():
-    """Main function"""
+@functools.lru_cache(maxsize=4)
+def get_encoding(model):
+    """Load model's tokenizer once, falling back to cl100k_base; building its BPE tables is slow"""
     try:
-        print("Starting transcription...")
-        transcriptions = transcribe_container()
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+class TokenChunker:
+    """Split text fed in pieces into token windows, each overlapping the previous, emitting each as soon as it fills"""
+    
+    def __init__(self, encoding, size=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+        self.size = size
+        self.overlap = overlap
+        self.encoding = encoding
+        self.tokens = []
+        # Leading tokens of the buffer that already went out at the end of the previous window
+        self.emitted = 0
+    
+    def feed(self, text):
+        """Add text, returning the windows it completed"""
+        self.tokens.extend(self.encoding.encode(text))
+        windows = []
+        while len(self.tokens) >= self.size:
+            windows.append(self.encoding.decode(self.tokens[:self.size]))
+            self.tokens = self.tokens[self.size - self.overlap:]
+            self.emitted = self.overlap
+        return windows
+    
+    def flush(self):
+        """Return the final partial window, unless everything fed has already been emitted"""
+        if self.emitted and len(self.tokens) <= self.emitted:
+            return []
+        return [self.encoding.decode(self.tokens)]
+
+class TranscriptChunker(TokenChunker):
+    """Chunk one file's transcript phrase by phrase, the same way for downloaded and cached phrases"""
+    
+    def __init__(self, filename, encoding, size=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+        super().__init__(encoding, size, overlap)
+        self.feed(f"{filename}: ")
+        self.has_phrases = False
+    
+    def feed_phrase(self, phrase):
+        """Add one recognized phrase, returning the windows it completed"""
+        self.has_phrases = True
+        return self.feed(phrase + ' ')
+    
+    def flush(self):
+        """Return the final partial window, or nothing for a file without phrases rather than its bare label"""
+        return super().flush() if self.has_phrases else []
+
+def chunk_phrases(filename, phrases, encoding, size=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+    """Chunk a file's phrases exactly as fetch_transcript does while downloading them"""
+    # Tokenizing the joined transcript instead would move chunk boundaries and miss the summary cache
+    chunker = TranscriptChunker(filename, encoding, size, overlap)
+    windows = [window for phrase in phrases for window in chunker.feed_phrase(phrase)]
+    return windows + chunker.flush()
+
+def truncate_tokens(text, encoding, limit):
+    """Cut text to at most limit tokens so an oversized request is never sent only to be rejected"""
+    tokens = encoding.encode(text)
+    if len(tokens) <= limit:
+        return text
+    logger.info(f"Truncating summarization input from {len(tokens)} to {limit} tokens")
+    return encoding.decode(tokens[:limit])
+
+class DeltaBuffer:
+    """on_delta callback that keeps every delta, so a listener attached later still sees the whole stream"""
+    
+    def __init__(self):
+        self.parts = []
+        self.listener = None
+    
+    def __call__(self, delta):
+        self.parts.append(delta)
+        if self.listener:
+            self.listener(delta)
+    
+    def attach(self, listener):
+        """Replay the deltas so far to listener, then pass it each new one as it arrives"""
+        for part in self.parts:
+            listener(part)
+        self.listener = listener
+
+class Summarizer:
+    """Map-reduce summarizer: chunk summaries start on submit, reduce per file, then across files"""
+    
+    def __init__(self, config, chat):
+        self.config = config
+        self.chat = chat
+        self.encoding = get_encoding(config.tokenizer_model)
+        # HTTP/2 multiplexes requests over one connection, so bound concurrency explicitly
+        self.semaphore = asyncio.Semaphore(config.openai_concurrency)
+        self.partials = {}
+        # Deltas of each chunk summary, in case it turns out to be the only one and so the final summary
+        self.streams = {}
+    
+    def submit(self, group, chunk):
+        """Start summarizing chunk as part of group, a (job, file) pair; groups are reduced in order"""
+        stream = DeltaBuffer()
+        self.partials.setdefault(group, []).append(asyncio.create_task(self._summarize(chunk, stream)))
+        self.streams.setdefault(group, []).append(stream)
+    
+    def discard(self, job):
+        """Drop every group of a failed job, cancelling its chunk summaries that are still running"""
+        for group in [group for group in self.partials if group[0] == job]:
+            del self.streams[group]
+            for task in self.partials.pop(group):
+                task.cancel()
+    
+    async def _summarize(self, text, on_delta=None):
+        async with self.semaphore:
+            return await summarize_text(self.config, self.chat, text, on_delta)
+    
+    async def _reduce(self, summaries, on_delta=None):
+        if len(summaries) == 1:
+            if on_delta:
+                on_delta(summaries[0])
+            return summaries[0]
+        # Chunks are sized to fit, but many partial summaries together may not be
+        return await self._summarize(
+            truncate_tokens('\n\n'.join(summaries), self.encoding, self.config.max_input_tokens), on_delta
+        )
+    
+    async def _reduce_files(self, groups):
+        """Reduce each file's chunk summaries, batching the uncached ones into one request when enabled and they fit"""
+        reduced = {}
+        texts = {}
+        for index, summaries in enumerate(groups):
+            if len(summaries) == 1:
+                reduced[index] = summaries[0]
+            else:
+                texts[index] = truncate_tokens('\n\n'.join(summaries), self.encoding, self.config.max_input_tokens)
         
-        print(f"\nTranscription completed for {len(transcriptions)} files:")
-        combined_text = ""
+        uncached = {str(index): text for index, text in texts.items() if cache_get(self.config, summary_cache_key(self.config, text)) is None}
+        if self.config.batch_reduce and len(uncached) > 1:
+            async with self.semaphore:
+                batched = await summarize_batch(self.config, self.chat, uncached)
+            if batched is not None:
+                reduced.update((int(name), summary) for name, summary in batched.items())
+        
+        remaining = [index for index in texts if index not in reduced]
+        summaries = await asyncio.gather(*[self._summarize(texts[index]) for index in remaining])
+        reduced.update(zip(remaining, summaries))
+        return [reduced[index] for index in range(len(groups))]
+    
+    async def result(self, on_delta=None):
+        """Wait for every file summary and reduce them into the final summary, streaming it to on_delta"""
+        if len(self.partials) == 1:
+            # A single file's summary is the final one, so stream it rather than print it once it is done
+            (group,) = self.partials
+            tasks = self.partials[group]
+            if len(tasks) > 1:
+                return await self._reduce(await asyncio.gather(*tasks), on_delta)
+            if on_delta:
+                self.streams[group][0].attach(on_delta)
+            return await tasks[0]
+        
+        groups = await asyncio.gather(*[asyncio.gather(*self.partials[group]) for group in sorted(self.partials)])
+        file_summaries = await self._reduce_files(groups)
+        if not file_summaries:
+            return ""
         
-        for filename, transcript in transcriptions.items():
+        if len(file_summaries) > 1:
+            logger.info(f"Combining {len(file_summaries)} file summaries...")
+        return await self._reduce(file_summaries, on_delta)
+
+async def transcribe_and_summarize(config, on_delta=None):
+    """Transcribe the container and summarize it, summarizing chunks while results are still downloading"""
+    async with speech_client(config) as speech, async_client() as blobs, openai_client(config) as chat:
+        # Key transcripts on blob versions rather than the SAS URL, so a rotated token still hits
+        # the cache while an added or replaced audio file misses it
+        listing = await list_blobs(blobs, config.container_uri)
+        key = cache_key('phrases', config.container_uri.split('?')[0], *(f"{name}\0{etag}" for name, etag in listing))
+        transcriptions = cache_get(config, key)
+        summarizer = Summarizer(config, chat)
+        
+        if transcriptions is not None:
+            logger.info(f"Using cached transcription for container: {config.container_uri}")
+            for index, (filename, phrases) in enumerate(transcriptions.items()):
+                for chunk in chunk_phrases(filename, phrases, summarizer.encoding):
+                    summarizer.submit((0, index), chunk)
+        else:
+            # Shared across jobs so per-file jobs do not multiply the download limit
+            semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+            
+            async def fetch(job, name, files_url):
+                return await get_results(speech, blobs, files_url, summarizer, semaphore, job, name)
+            
+            results = await transcribe_container(config, speech, listing, fetch)
+            for job, result in enumerate(results):
+                # A job can fail after part of its result streamed in and was already submitted
+                if result is None:
+                    summarizer.discard(job)
+            finished = [result for result in results if result is not None]
+            transcriptions = {filename: phrases for result, _ in finished for filename, phrases in result.items()}
+            # A partial set would otherwise be served for every run until it expired
+            if transcriptions and len(finished) == len(results) and all(complete for _, complete in finished):
+                cache_set(config, key, transcriptions)
+        
+        print(f"\nTranscription completed for {len(transcriptions)} files:")
+        for filename, phrases in transcriptions.items():
             print(f"\n--- {filename} ---")
-            print(f"Transcript: {transcript}")
-            combined_text += f"\n{filename}: {transcript}"
+            print(f"Transcript: {' '.join(phrases)}")
         
         print("\n" + "="*50)
-        print("Starting summarization...")
-        summary = summarize_text(combined_text)
-        print(f"Summary:\n{summary}")
+        logger.info("Finishing summarization...")
+        return await summarizer.result(on_delta)
+
+def print_stream(title):
+    """Return an on_delta callback that prints title before the first delta, then each delta as it arrives"""
+    started = False
+    
+    def on_delta(delta):
+        nonlocal started
+        if not started:
+            print(title)
+            started = True
+        print(delta, end='', flush=True)
+    
+    return on_delta
+
+def start_logging():
+    """Route this module's log records through a queue so a background thread does the stdout writes"""
+    log_queue = queue.Queue(-1)
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(log_queue, handler)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener.start()
+    return listener
+
+def main():
+    """Main function"""
+    listener = start_logging()
+    try:
+        config = load_config()
+        
+        logger.info("Starting transcription...")
+        asyncio.run(transcribe_and_summarize(config, print_stream("Summary:")))
+        print()
         
     except Exception as e:
-        print(f"Error: {e}")
+        # Through the queue too, so the error comes after the progress records that preceded it
+        logger.error(f"Error: {e}")
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -13,45 +14,6 @@ print(f"Endpoint: {endpoint}")
 print(f"Key length: {len(key) if key else 'None'}")
 print(f"Deployment: {deployment}")
 
-# Try different import and initialization methods
-print("\n=== Method 1: Standard AzureOpenAI ===")
-try:
-    from openai import AzureOpenAI
-    client = AzureOpenAI(
-        azure_endpoint=endpoint,
-        api_key=key,
-        api_version="2023-12-01-preview"
-    )
-    print("✅ Method 1: Client created successfully!")
-    
-    response = client.chat.completions.create(
-        model=deployment,
-        messages=[{"role": "user", "content": "Say hello"}],
-        max_tokens=50
-    )
-    print(f"✅ Response: {response.choices[0].message.content}")
-    
-except Exception as e:
-    print(f"❌ Method 1 failed: {e}")
-
-print("\n=== Method 2: OpenAI with Azure endpoint ===")
-try:
-    import openai
-    openai.api_type = "azure"
-    openai.api_base = endpoint
-    openai.api_version = "2023-12-01-preview"
-    openai.api_key = key
-    
-    response = openai.ChatCompletion.create(
-        engine=deployment,
-        messages=[{"role": "user", "content": "Say hello"}],
-        max_tokens=50
-    )
-    print(f"✅ Method 2 Response: {response.choices[0].message.content}")
-    
-except Exception as e:
-    print(f"❌ Method 2 failed: {e}")
-
 print("\n=== Method 3: Direct requests ===")
 try:
     import requests
@@ -76,3 +38,43 @@ try:
         
 except Exception as e:
     print(f"❌ Method 3 failed: {e}")
+
+# The SDK methods import the whole openai package, so only try them when asked to
+if __name__ == '__main__' and '--probe' in sys.argv:
+    print("\n=== Method 1: Standard AzureOpenAI ===")
+    try:
+        from openai import AzureOpenAI
+        client = AzureOpenAI(
+            azure_endpoint=endpoint,
+            api_key=key,
+            api_version="2023-12-01-preview"
+        )
+        print("✅ Method 1: Client created successfully!")
+    
+        response = client.chat.completions.create(
+            model=deployment,
+            messages=[{"role": "user", "content": "Say hello"}],
+            max_tokens=50
+        )
+        print(f"✅ Response: {response.choices[0].message.content}")
+    
+    except Exception as e:
+        print(f"❌ Method 1 failed: {e}")
+
+    print("\n=== Method 2: OpenAI with Azure endpoint ===")
+    try:
+        import openai
+        openai.api_type = "azure"
+        openai.api_base = endpoint
+        openai.api_version = "2023-12-01-preview"
+        openai.api_key = key
+    
+        response = openai.ChatCompletion.create(
+            engine=deployment,
+            messages=[{"role": "user", "content": "Say hello"}],
+            max_tokens=50
+        )
+        print(f"✅ Method 2 Response: {response.choices[0].message.content}")
+    
+    except Exception as e:
+        print(f"❌ Method 2 failed: {e}")
@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+
+import httpx
+import orjson
+
+import app
+
+
+class CharEncoding:
+    """One token per character, so chunk boundaries are sensitive to every byte fed in"""
+
+    def encode(self, text):
+        return list(text)
+
+    def decode(self, tokens):
+        return ''.join(tokens)
+
+
+def live_chunks(filename, phrases, encoding):
+    """Chunks fetch_transcript submits while stream-parsing a result file holding phrases"""
+    document = {"recognizedPhrases": [{"nBest": [{"display": phrase}]} for phrase in phrases]}
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=orjson.dumps(document)))
+    submitted = []
+
+    async def fetch():
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await app.fetch_transcript(client, "https://blob/result", filename, encoding, submitted.append)
+
+    return asyncio.run(fetch()), submitted
+
+
+class TranscriptChunkingTest(unittest.TestCase):
+    def test_cached_phrases_chunk_like_a_download(self):
+        encoding = CharEncoding()
+        phrases = [f"Phrase number {i} is here." for i in range(400)] + ["Fine."]
+        fetched, submitted = live_chunks("a.wav", phrases, encoding)
+
+        self.assertEqual(fetched, phrases)
+        self.assertGreater(len(submitted), 1)
+        self.assertEqual(app.chunk_phrases("a.wav", fetched, encoding), submitted)
+
+    def test_file_without_phrases_has_no_chunks(self):
+        encoding = CharEncoding()
+        fetched, submitted = live_chunks("silence.wav", [], encoding)
+
+        self.assertEqual(fetched, [])
+        self.assertEqual(submitted, [])
+        self.assertEqual(app.chunk_phrases("silence.wav", [], encoding), [])
+
+
+if __name__ == '__main__':
+    unittest.main()